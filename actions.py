@@ -1,9 +1,29 @@
 import random
+import re
+from functools import lru_cache
 
 
+# 最内层的一对括号；反复替换即可逐层去掉嵌套的动作描写。
+_ACTION_RE = re.compile(r"\([^()]*\)")
+
+_RNG = random.Random()
+
+
+@lru_cache(maxsize=512)
 def strip_action(text: str) -> str:
     if "(" not in text or ")" not in text:
         return text.strip()
+    prev = None
+    cur = text
+    while cur != prev:
+        prev = cur
+        cur = _ACTION_RE.sub("", cur)
+    if "(" not in cur and ")" not in cur:
+        return cur.strip()
+    return _strip_unbalanced(cur)
+
+
+def _strip_unbalanced(text: str) -> str:
     parts = []
     depth = 0
     for ch in text:
@@ -18,10 +38,13 @@ def strip_action(text: str) -> str:
     return "".join(parts).strip()
 
 
-def pick_action(actions: list[str], fallback: str) -> str:
-    if actions:
-        candidates = [item for item in actions if item.strip()]
-        return random.choice(candidates or actions)
+def action_candidates(actions: list[str]) -> list[str]:
+    return [item for item in actions if item.strip()] or list(actions)
+
+
+def pick_action(candidates: list[str], fallback: str) -> str:
+    if candidates:
+        return _RNG.choice(candidates)
     return fallback
 
 
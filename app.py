@@ -1,21 +1,52 @@
+import atexit
 import csv
+import io
 import json
+import logging
+import os
 import random
 import time
-from dataclasses import dataclass
+from bisect import bisect_left, bisect_right
+from collections import deque
+from dataclasses import dataclass, field
 from datetime import datetime
+from functools import lru_cache
+from itertools import chain, islice
 from pathlib import Path
+from typing import TextIO
 
+import mlx.nn as nn
 from mlx_lm import generate, load
+from mlx_lm.utils import quantize_model
 
-from actions import attach_action, pick_action, strip_action
+from actions import action_candidates, attach_action, pick_action, strip_action
 from dialog import display_dialog, notify_then_dialog
-from llm import generate_reply, sanitize_role_prompt
+from llm import (
+    PrefixCache,
+    draft_kwargs,
+    init_clean_reply,
+    iter_reply_candidates,
+    make_prefix_cache,
+    sanitize_role_prompt,
+)
+
+logger = logging.getLogger(__name__)
+
+APP_LOGGERS = ("__main__", "app", "llm", "dialog")
+
+DIALOG_DIRECTIONS = ("user", "cat")
+
+# 比较回复时忽略的标点与空格，一次 translate 全部去除。
+_PUNCT_TABLE = str.maketrans("", "", "，。！？、,.!?~ ")
 
 
 @dataclass
 class AppConfig:
     model_path: str
+    draft_model_path: str | None
+    num_draft_tokens: int
+    quantize_bits: int
+    quantize_group_size: int
     role_prompt_path: Path
     min_seconds: int
     max_seconds: int
@@ -24,15 +55,61 @@ class AppConfig:
     compress_batch: int
     max_tokens: int
     max_retries: int
+    retry_temperature: float
     use_tkinter: bool
     cooldown_seconds: int
     dialog_backend: str
     history_max_turns: int
     history_max_chars: int
     actions: list[str]
+    action_candidates: list[str]
     notification_timeout_seconds: int
 
 
+@dataclass
+class LogTail:
+    rows: deque[tuple[str, str]] = field(default_factory=deque)
+    latest_summary: str = ""
+    row_count: int = 0
+
+
+# 最近的对话行与最新摘要，供上下文构建使用，避免每轮重读整个日志。
+_LOG_TAIL = LogTail()
+
+
+# 进程内常驻的日志追加句柄，避免每次写入都重新打开文件。
+class LogWriter:
+    def __init__(self) -> None:
+        self._path: Path | None = None
+        self._fh: TextIO | None = None
+        self._writer = None
+
+    def writerow(self, log_path: Path, row: list[str]) -> None:
+        if self._fh is None or self._path != log_path or not log_path.exists():
+            self.close()
+            ensure_log_file(log_path)
+            self._fh = log_path.open("a", encoding="utf-8", newline="")
+            self._writer = csv.writer(self._fh)
+            self._path = log_path
+        self._writer.writerow(row)
+        self._fh.flush()
+
+    def close(self) -> None:
+        if self._fh is not None:
+            self._fh.close()
+        self._path = None
+        self._fh = None
+        self._writer = None
+
+
+_LOG_WRITER = LogWriter()
+atexit.register(_LOG_WRITER.close)
+
+# 同一秒内的多条日志复用已格式化的时间戳。
+_LAST_TS_SEC = -1
+_LAST_TS_STR = ""
+
+
 def load_config() -> AppConfig:
     base_dir = Path(__file__).resolve().parent
     with (base_dir / "config.json").open("r", encoding="utf-8") as f:
@@ -43,9 +120,18 @@ def load_config() -> AppConfig:
     model_path = model_list.get(model_key) if model_key else raw.get("model_path")
     if not model_path:
         raise ValueError("未配置模型路径，请检查 config.json 中 models 设置。")
+    draft_key = raw.get("models", {}).get("draft")
+    draft_model_path = model_list.get(draft_key) if draft_key else None
+    if draft_key and not draft_model_path:
+        raise ValueError(f"草稿模型 {draft_key} 不在 models.list 中，请检查 config.json。")
+    actions = list(raw.get("actions", []))
 
     return AppConfig(
         model_path=model_path,
+        draft_model_path=draft_model_path,
+        num_draft_tokens=int(raw.get("models", {}).get("num_draft_tokens", 4)),
+        quantize_bits=int(raw.get("models", {}).get("quantize_bits", 4)),
+        quantize_group_size=int(raw.get("models", {}).get("quantize_group_size", 64)),
         role_prompt_path=base_dir / raw["role_prompt_path"],
         min_seconds=int(raw["trigger"]["min_seconds"]),
         max_seconds=int(raw["trigger"]["max_seconds"]),
@@ -54,24 +140,57 @@ def load_config() -> AppConfig:
         compress_batch=int(raw["log"]["compress_batch"]),
         max_tokens=int(raw["generation"]["max_tokens"]),
         max_retries=int(raw.get("generation", {}).get("max_retries", 3)),
+        retry_temperature=float(raw.get("generation", {}).get("retry_temperature", 0.8)),
         use_tkinter=bool(raw.get("dialog", {}).get("use_tkinter", True)),
         cooldown_seconds=int(raw.get("dialog", {}).get("cooldown_seconds", 5)),
         dialog_backend=str(raw.get("dialog", {}).get("backend", "pyobjc")),
         history_max_turns=int(raw.get("history", {}).get("max_turns", 6)),
         history_max_chars=int(raw.get("history", {}).get("max_chars", 400)),
-        actions=list(raw.get("actions", [])),
+        actions=actions,
+        action_candidates=action_candidates(actions),
         notification_timeout_seconds=int(
             raw.get("dialog", {}).get("notification_timeout_seconds", 5)
         ),
     )
 
 
-def setup_model(model_path: str):
+def setup_model(
+    model_path: str,
+    quantize_bits: int = 4,
+    quantize_group_size: int = 64,
+    draft_model_path: str | None = None,
+):
     print(f"🚀 正在通过 MLX 加载模型: {model_path}...")
     print("   (初次运行会自动从 HuggingFace 下载权重，约 9GB，请耐心等待)")
     model, tokenizer = load(model_path)
+    quantize_model_if_needed(model, quantize_bits, quantize_group_size)
+    init_clean_reply(tokenizer)
+    draft_model = None
+    if draft_model_path:
+        print(f"🚀 正在加载草稿模型: {draft_model_path}...")
+        draft_model, _ = load(draft_model_path)
+        quantize_model_if_needed(draft_model, quantize_bits, quantize_group_size)
     print("✅ 模型加载完成！")
-    return model, tokenizer
+    return model, tokenizer, draft_model
+
+
+def quantize_model_if_needed(model, bits: int, group_size: int) -> None:
+    if bits <= 0:
+        return
+    if any(isinstance(m, nn.QuantizedLinear) for m in model.modules()):
+        return
+    print(f"🗜️ 模型为全精度，正在量化为 {bits}bit (group_size={group_size})...")
+    # 参数按位置传入，兼容 mlx_lm 各版本中不同的关键字命名。
+    quantize_model(model, {}, group_size, bits)
+
+
+def _now_iso() -> str:
+    global _LAST_TS_SEC, _LAST_TS_STR
+    sec = int(time.time())
+    if sec != _LAST_TS_SEC:
+        _LAST_TS_STR = datetime.fromtimestamp(sec).isoformat(timespec="seconds")
+        _LAST_TS_SEC = sec
+    return _LAST_TS_STR
 
 
 def ensure_log_file(log_path: Path) -> None:
@@ -83,11 +202,36 @@ def ensure_log_file(log_path: Path) -> None:
             writer.writerow(["timestamp", "direction", "content"])
 
 
+def _track_log_row(direction: str, content: str) -> None:
+    _LOG_TAIL.row_count += 1
+    if direction == "summary":
+        _LOG_TAIL.latest_summary = content
+    elif direction in DIALOG_DIRECTIONS:
+        _LOG_TAIL.rows.append((direction, content))
+
+
+def _rebuild_log_tail(rows: list[list[str]], max_rows: int) -> None:
+    _LOG_TAIL.rows = deque(maxlen=max_rows)
+    _LOG_TAIL.latest_summary = ""
+    _LOG_TAIL.row_count = 0
+    for _, direction, content in rows:
+        _track_log_row(direction, content)
+
+
+def load_log_tail(log_path: Path, max_turns: int) -> None:
+    max_rows = max_turns * 4
+    _rebuild_log_tail(read_log_tail(log_path, max_rows * 2), max_rows)
+    if not _LOG_TAIL.latest_summary:
+        head = read_log_head(log_path, 1)
+        if head and len(head[0]) == 3 and head[0][1] == "summary":
+            _LOG_TAIL.latest_summary = head[0][2]
+    _LOG_TAIL.row_count = count_log_lines(log_path)
+
+
 def append_log(log_path: Path, direction: str, content: str) -> None:
-    print(f"🧾 写入日志 [{direction}]: {content}")
-    with log_path.open("a", encoding="utf-8", newline="") as f:
-        writer = csv.writer(f)
-        writer.writerow([datetime.now().isoformat(timespec="seconds"), direction, content])
+    logger.debug("🧾 写入日志 [%s]: %s", direction, content)
+    _LOG_WRITER.writerow(log_path, [_now_iso(), direction, content])
+    _track_log_row(direction, content)
 
 
 def read_logs(log_path: Path) -> list[list[str]]:
@@ -97,39 +241,88 @@ def read_logs(log_path: Path) -> list[list[str]]:
     return rows[1:]
 
 
+def read_log_head(log_path: Path, n: int) -> list[list[str]]:
+    with log_path.open("r", encoding="utf-8", newline="") as f:
+        return list(islice(csv.reader(f), 1, n + 1))
+
+
+def _is_log_row(row: list[str]) -> bool:
+    if len(row) != 3:
+        return False
+    try:
+        datetime.fromisoformat(row[0])
+    except ValueError:
+        return False
+    return True
+
+
+def _format_rows(rows: list[list[str]]) -> str:
+    buffer = io.StringIO()
+    csv.writer(buffer).writerows(rows)
+    return buffer.getvalue()
+
+
+def read_log_tail(log_path: Path, n: int, chunk_size: int = 8192) -> list[list[str]]:
+    with log_path.open("rb") as f:
+        size = f.seek(0, 2)
+        while chunk_size < size:
+            f.seek(size - chunk_size)
+            text = f.read().split(b"\n", 1)[-1].decode("utf-8", errors="replace")
+            rows = list(csv.reader(text.splitlines(keepends=True)))
+            start = next((i for i, row in enumerate(rows) if _is_log_row(row)), len(rows))
+            rows = rows[start:]
+            # 切点可能落在多行字段内部，回写校验不一致就扩大窗口。
+            if len(rows) > n and text.endswith(_format_rows(rows)):
+                return rows[-n:]
+            chunk_size *= 2
+    with log_path.open("r", encoding="utf-8", newline="") as f:
+        return list(deque(islice(csv.reader(f), 1, None), maxlen=n))
+
+
+def count_log_lines(log_path: Path, chunk_size: int = 1 << 16) -> int:
+    count = 0
+    with log_path.open("rb") as f:
+        while chunk := f.read(chunk_size):
+            count += chunk.count(b"\n")
+    return max(count - 1, 0)
+
+
 def write_logs(log_path: Path, rows: list[list[str]]) -> None:
+    # 关闭常驻句柄，下次追加时重新打开改写后的文件。
+    _LOG_WRITER.close()
     with log_path.open("w", encoding="utf-8", newline="") as f:
         writer = csv.writer(f)
         writer.writerow(["timestamp", "direction", "content"])
         writer.writerows(rows)
+    _rebuild_log_tail(rows, _LOG_TAIL.rows.maxlen)
+
+
+def _tail_join(pairs, max_chars: int, leading: str = "") -> str:
+    lines = (f"{role}: {text}" for role, text in reversed(pairs))
+    if leading:
+        lines = chain(lines, [leading])
+    acc: list[str] = []
+    total = 0
+    for line in lines:
+        cost = len(line) + (1 if acc else 0)
+        if total + cost > max_chars and acc:
+            break
+        acc.append(line)
+        total += cost
+    return "\n".join(reversed(acc))[-max_chars:].strip()
 
 
 def build_history_context(
-    log_path: Path,
     max_turns: int,
     max_chars: int,
 ) -> str:
-    rows = read_logs(log_path)
-    if not rows:
+    summary = _LOG_TAIL.latest_summary
+    if not _LOG_TAIL.rows and not summary:
         return "无"
 
-    summary_lines = [row[2] for row in rows if row[1] == "summary"]
-    summary = summary_lines[-1] if summary_lines else ""
-
-    dialog_rows = [row for row in rows if row[1] in ("user", "cat")]
-    tail = dialog_rows[-max_turns * 2 :]
-    lines = [f"{direction}: {content}" for _, direction, content in tail]
-    history = "\n".join(lines).strip()
-
-    if summary:
-        combined = f"摘要：{summary}\n{history}".strip()
-    else:
-        combined = history
-
-    if len(combined) > max_chars:
-        combined = combined[-max_chars:]
-        combined = combined.split("\n", 1)[-1].strip()
-    return combined or "无"
+    tail = list(_LOG_TAIL.rows)[-max_turns * 2 :]
+    leading = f"摘要：{summary}" if summary else ""
+    return _tail_join(tail, max_chars, leading) or "无"
 
 
 def build_session_context(
@@ -141,44 +334,68 @@ def build_session_context(
         return "无"
 
     tail = session_entries[-max_turns * 2 :]
-    lines = [f"{role}: {text}" for role, text in tail]
-    combined = "\n".join(lines).strip()
-    if len(combined) > max_chars:
-        combined = combined[-max_chars:]
-        combined = combined.split("\n", 1)[-1].strip()
-    return combined or "无"
+    return _tail_join(tail, max_chars) or "无"
 
 
-def get_recent_cat_replies(log_path: Path, limit: int) -> list[str]:
-    rows = read_logs(log_path)
-    cat_rows = [strip_action(row[2]) for row in rows if row[1] == "cat"]
+def get_recent_cat_replies(limit: int) -> list[str]:
+    cat_rows = [
+        strip_action(content) for direction, content in _LOG_TAIL.rows if direction == "cat"
+    ]
     return cat_rows[-limit:]
 
 
+@lru_cache(maxsize=512)
 def normalize_for_compare(text: str) -> str:
-    cleaned = strip_action(text)
-    for ch in ["，", "。", "！", "？", "、", ",", ".", "!", "?", "~", " "]:
-        cleaned = cleaned.replace(ch, "")
-    return cleaned.lower()
+    return strip_action(text).translate(_PUNCT_TABLE).lower()
+
+
+MIN_SUBSTRING_LEN = 3
+
+RecentNorms = tuple[set[str], list[str], list[int]]
+
 
+def precompute_recent(recent: list[str]) -> RecentNorms:
+    norms = {normalize_for_compare(item) for item in recent}
+    norms.discard("")
+    sorted_norms = sorted(norms, key=len)
+    return norms, sorted_norms, [len(ref) for ref in sorted_norms]
 
-def is_repetitive(candidate: str, recent: list[str]) -> bool:
-    if not candidate or not recent:
+
+def is_repetitive(candidate: str, precomputed: RecentNorms) -> bool:
+    exact_set, sorted_norms, lengths = precomputed
+    if not candidate or not exact_set:
         return False
     cand = normalize_for_compare(candidate)
     if not cand:
         return False
-    for item in recent:
-        ref = normalize_for_compare(item)
-        if not ref:
-            continue
-        if cand == ref:
+    if cand in exact_set:
+        return True
+    if len(cand) < MIN_SUBSTRING_LEN:
+        return False
+    start = bisect_left(lengths, MIN_SUBSTRING_LEN)
+    same_start = bisect_left(lengths, len(cand), start)
+    same_end = bisect_right(lengths, len(cand), same_start)
+    for index in range(start, same_start):
+        if sorted_norms[index] in cand:
             return True
-        if cand in ref or ref in cand:
+    for index in range(same_end, len(sorted_norms)):
+        if cand in sorted_norms[index]:
             return True
     return False
 
 
+def pick_reply(candidates, recent_norms: RecentNorms) -> str:
+    it = iter(candidates)
+    first = next(it, "")
+    if not is_repetitive(first, recent_norms):
+        return first
+    for reply in it:
+        print("🔁 检测到重复回复，正在重试...")
+        if not is_repetitive(reply, recent_norms):
+            return reply
+    return first
+
+
 def ensure_user_reference(reply: str, user_text: str) -> str:
     return reply
 
@@ -193,14 +410,18 @@ def summarize_logs_if_needed(
     max_records: int,
     compress_batch: int,
     max_tokens: int,
+    draft_model=None,
+    num_draft_tokens: int = 4,
 ) -> None:
-    rows = read_logs(log_path)
-    if len(rows) <= max_records:
+    if _LOG_TAIL.row_count <= max_records:
+        return
+    head = read_log_head(log_path, max(max_records, compress_batch) + 1)
+    if len(head) <= max_records:
+        _LOG_TAIL.row_count = len(head)
         return
 
-    print(f"🧹 日志过多，开始压缩：{len(rows)} -> {compress_batch}")
-    target_rows = rows[:compress_batch]
-    remainder = rows[compress_batch:]
+    print(f"🧹 日志超过 {max_records} 条，开始压缩前 {compress_batch} 条")
+    target_rows = head[:compress_batch]
     formatted = "\n".join(
         f"{direction}: {content}" for _, direction, content in target_rows
     )
@@ -222,15 +443,23 @@ def summarize_logs_if_needed(
         prompt=prompt,
         max_tokens=max_tokens,
         verbose=False,
+        **draft_kwargs(draft_model, num_draft_tokens),
     ).strip()
 
-    summary_row = [datetime.now().isoformat(timespec="seconds"), "summary", summary]
+    summary_row = [_now_iso(), "summary", summary]
+    remainder = read_logs(log_path)[compress_batch:]
     write_logs(log_path, [summary_row] + remainder)
 
 
-def run_cycle(config: AppConfig, model, tokenizer, role_prompt: str) -> None:
-    role_prompt = sanitize_role_prompt(role_prompt)
-    behavior = pick_action(config.actions, "扶正牛仔帽")
+def run_cycle(
+    config: AppConfig,
+    model,
+    tokenizer,
+    role_prompt: str,
+    prefix_cache: PrefixCache | None = None,
+    draft_model=None,
+) -> None:
+    behavior = pick_action(config.action_candidates, "扶正牛仔帽")
     user_text = ""
     session_entries: list[tuple[str, str]] = []
     session_text = build_session_context(
@@ -238,29 +467,29 @@ def run_cycle(config: AppConfig, model, tokenizer, role_prompt: str) -> None:
         config.history_max_turns,
         config.history_max_chars,
     )
-    recent_replies = get_recent_cat_replies(
-        config.log_path, config.history_max_turns * 2
-    )
+    recent_replies = get_recent_cat_replies(config.history_max_turns * 2)
     avoid_text = "\n".join(recent_replies[-2:]) or "无"
+    recent_norms = precompute_recent(recent_replies)
     print("🐾 开始生成首次回复...")
-    reply = ""
-    for attempt in range(config.max_retries):
-        reply = generate_reply(
-            model,
-            tokenizer,
-            role_prompt,
-            user_text,
-            behavior,
-            config.max_tokens,
-            session_text,
-            avoid_text,
-            "新对话",
-        )
-        if not is_repetitive(reply, recent_replies):
-            break
-        print("🔁 检测到重复回复，正在重试...")
+    candidates = iter_reply_candidates(
+        model,
+        tokenizer,
+        role_prompt,
+        user_text,
+        behavior,
+        config.max_tokens,
+        session_text,
+        avoid_text,
+        "新对话",
+        config.max_retries,
+        config.retry_temperature,
+        prefix_cache,
+        draft_model,
+        config.num_draft_tokens,
+    )
+    reply = pick_reply(candidates, recent_norms)
     print("🐾 首次回复生成完成。")
-    action = pick_action(config.actions, "扶正牛仔帽")
+    action = pick_action(config.action_candidates, "扶正牛仔帽")
     final_reply = attach_action(reply, action)
     append_log(config.log_path, "cat", final_reply)
     session_entries.append(("cat", reply))
@@ -289,33 +518,35 @@ def run_cycle(config: AppConfig, model, tokenizer, role_prompt: str) -> None:
             break
 
         append_log(config.log_path, "user", user_input)
-        behavior = pick_action(config.actions, "扶正牛仔帽")
+        behavior = pick_action(config.action_candidates, "扶正牛仔帽")
         session_entries.append(("user", user_input))
         session_text = build_session_context(
             session_entries,
             config.history_max_turns,
             config.history_max_chars,
         )
-        recent_replies = get_recent_cat_replies(config.log_path, config.history_max_turns * 2)
+        recent_replies = get_recent_cat_replies(config.history_max_turns * 2)
         avoid_text = "\n".join(recent_replies[-2:]) or "无"
-        reply = ""
-        for attempt in range(config.max_retries):
-            reply = generate_reply(
-                model,
-                tokenizer,
-                role_prompt,
-                user_input,
-                behavior,
-                config.max_tokens,
-                session_text,
-                avoid_text,
-                "连续对话",
-            )
-            if not is_repetitive(reply, recent_replies):
-                break
-            print("🔁 检测到重复回复，正在重试...")
+        recent_norms = precompute_recent(recent_replies)
+        candidates = iter_reply_candidates(
+            model,
+            tokenizer,
+            role_prompt,
+            user_input,
+            behavior,
+            config.max_tokens,
+            session_text,
+            avoid_text,
+            "连续对话",
+            config.max_retries,
+            config.retry_temperature,
+            prefix_cache,
+            draft_model,
+            config.num_draft_tokens,
+        )
+        reply = pick_reply(candidates, recent_norms)
         reply = ensure_user_reference(reply, user_input)
-        action = pick_action(config.actions, "扶正牛仔帽")
+        action = pick_action(config.action_candidates, "扶正牛仔帽")
         final_reply = attach_action(reply, action)
         append_log(config.log_path, "cat", final_reply)
         session_entries.append(("cat", reply))
@@ -338,14 +569,29 @@ def run_cycle(config: AppConfig, model, tokenizer, role_prompt: str) -> None:
         config.max_records,
         config.compress_batch,
         config.max_tokens,
+        draft_model,
+        config.num_draft_tokens,
     )
 
 
 def main() -> None:
+    logging.basicConfig(level=logging.INFO, format="%(message)s")
+    if os.environ.get("LIVE_PARTNER_DEBUG") == "1":
+        for name in APP_LOGGERS:
+            logging.getLogger(name).setLevel(logging.DEBUG)
     config = load_config()
-    role_prompt = config.role_prompt_path.read_text(encoding="utf-8")
+    role_prompt = sanitize_role_prompt(
+        config.role_prompt_path.read_text(encoding="utf-8")
+    )
     ensure_log_file(config.log_path)
-    model, tokenizer = setup_model(config.model_path)
+    load_log_tail(config.log_path, config.history_max_turns)
+    model, tokenizer, draft_model = setup_model(
+        config.model_path,
+        config.quantize_bits,
+        config.quantize_group_size,
+        config.draft_model_path,
+    )
+    prefix_cache = make_prefix_cache(model, tokenizer, role_prompt, draft_model)
 
     print("🐾 干嘛猫开始随机出没，按 Ctrl+C 退出。")
     while True:
@@ -353,7 +599,7 @@ def main() -> None:
         print(f"⏳ 下一次干嘛猫出现时间: {sleep_seconds} 秒")
         # time.sleep(sleep_seconds)
         print("⏰ 触发一次对话周期")
-        run_cycle(config, model, tokenizer, role_prompt)
+        run_cycle(config, model, tokenizer, role_prompt, prefix_cache, draft_model)
 
 
 if __name__ == "__main__":
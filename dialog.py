@@ -1,7 +1,57 @@
+import atexit
 import importlib
+import logging
 import subprocess
 import time
 
+logger = logging.getLogger(__name__)
+
+# 进程内复用的隐藏 Tk 根窗口，每次只创建/销毁 Toplevel。
+_tk_root = None
+_tk_modules = None
+
+
+def _init_tk():
+    global _tk_root, _tk_modules
+    if _tk_root is not None:
+        return _tk_modules
+
+    import tkinter as tk
+    from tkinter import ttk
+
+    root = tk.Tk()
+    root.withdraw()
+    style = ttk.Style(root)
+    try:
+        style.theme_use("aqua")
+    except Exception:
+        pass
+    atexit.register(root.destroy)
+    _tk_root = root
+    _tk_modules = (tk, ttk, root)
+    return _tk_modules
+
+
+# PyObjC 的 AppKit/Foundation 只导入一次；导入失败也记下来，避免每次重试。
+_cocoa_modules = None
+_cocoa_error: Exception | None = None
+
+
+def _load_cocoa():
+    global _cocoa_modules, _cocoa_error
+    if _cocoa_modules is not None:
+        return _cocoa_modules
+    if _cocoa_error is not None:
+        raise _cocoa_error
+    try:
+        appkit = importlib.import_module("AppKit")
+        foundation = importlib.import_module("Foundation")
+    except Exception as exc:
+        _cocoa_error = exc
+        raise
+    _cocoa_modules = (appkit, foundation)
+    return _cocoa_modules
+
 
 def display_dialog(message: str, use_tkinter: bool = True, backend: str = "pyobjc") -> tuple[bool, str]:
     if backend == "pyobjc":
@@ -22,9 +72,11 @@ def notify_then_dialog(
     use_tkinter: bool = True,
     backend: str = "pyobjc",
 ) -> tuple[bool, str, bool]:
+    # 只有 Tk 通知能感知点击；不可用时优先走 PyObjC 系统通知，最后才启动 osascript。
     clicked = display_notification_tk(message, timeout_seconds)
     if clicked is None:
-        display_notification_osascript(message)
+        if not display_notification_cocoa(message):
+            display_notification_osascript(message)
         time.sleep(timeout_seconds)
         return False, "", False
 
@@ -48,7 +100,7 @@ def display_dialog_osascript(message: str) -> tuple[bool, str]:
         "end try"
     )
     try:
-        print("🪟 正在唤起弹窗...")
+        logger.debug("🪟 正在唤起弹窗...")
         result = subprocess.run(
             ["osascript", "-e", applescript],
             capture_output=True,
@@ -63,7 +115,7 @@ def display_dialog_osascript(message: str) -> tuple[bool, str]:
         return False, ""
 
     output = result.stdout.strip()
-    print("🪟 弹窗返回:", output)
+    logger.debug("🪟 弹窗返回: %s", output)
     parts = dict(
         item.split(":", 1) for item in output.split(", ") if ":" in item
     )
@@ -89,17 +141,32 @@ def display_notification_osascript(message: str) -> None:
         print("stderr:", (exc.stderr or "").strip())
 
 
+def display_notification_cocoa(message: str) -> bool:
+    try:
+        _, foundation = _load_cocoa()
+        NSUserNotification = getattr(foundation, "NSUserNotification")
+        NSUserNotificationCenter = getattr(foundation, "NSUserNotificationCenter")
+    except Exception as exc:
+        print("⚠️ PyObjC 不可用，回退到 osascript 通知。", exc)
+        return False
+
+    center = NSUserNotificationCenter.defaultUserNotificationCenter()
+    if center is None:
+        return False
+    notification = NSUserNotification.alloc().init()
+    notification.setTitle_("干嘛猫")
+    notification.setInformativeText_(message)
+    center.deliverNotification_(notification)
+    return True
+
+
 def display_dialog_tk(message: str) -> tuple[bool, str] | None:
     try:
-        import tkinter as tk
-        from tkinter import ttk
+        tk, ttk, root = _init_tk()
     except Exception as exc:
         print("⚠️ Tkinter 不可用，回退到 osascript。", exc)
         return None
 
-    root = tk.Tk()
-    root.withdraw()
-
     dialog = tk.Toplevel(root)
     dialog.title("干嘛猫")
     dialog.configure(bg="#f6f6f6")
@@ -112,12 +179,6 @@ def display_dialog_tk(message: str) -> tuple[bool, str] | None:
     y = int((dialog.winfo_screenheight() - height) / 3)
     dialog.geometry(f"{width}x{height}+{x}+{y}")
 
-    style = ttk.Style(dialog)
-    try:
-        style.theme_use("aqua")
-    except Exception:
-        pass
-
     container = ttk.Frame(dialog, padding=16)
     container.pack(fill="both", expand=True)
 
@@ -154,21 +215,16 @@ def display_dialog_tk(message: str) -> tuple[bool, str] | None:
     dialog.lift()
     dialog.focus_force()
     root.wait_window(dialog)
-    root.destroy()
     return result["sent"], result["text"]
 
 
 def display_notification_tk(message: str, timeout_seconds: int) -> bool | None:
     try:
-        import tkinter as tk
-        from tkinter import ttk
+        tk, ttk, root = _init_tk()
     except Exception as exc:
         print("⚠️ Tkinter 不可用，回退到系统通知。", exc)
         return None
 
-    root = tk.Tk()
-    root.withdraw()
-
     notify = tk.Toplevel(root)
     notify.title("干嘛猫通知")
     notify.configure(bg="#f6f6f6")
@@ -246,7 +302,6 @@ def display_notification_tk(message: str, timeout_seconds: int) -> bool | None:
     after_id["value"] = notify.after(max(100, timeout_seconds * 1000), fade_out)
     notify.protocol("WM_DELETE_WINDOW", on_close)
     root.mainloop()
-    root.destroy()
 
     if clicked["value"]:
         return True
@@ -257,8 +312,7 @@ def display_notification_tk(message: str, timeout_seconds: int) -> bool | None:
 
 def display_dialog_cocoa(message: str) -> tuple[bool, str] | None:
     try:
-        appkit = importlib.import_module("AppKit")
-        foundation = importlib.import_module("Foundation")
+        appkit, foundation = _load_cocoa()
 
         NSAlert = getattr(appkit, "NSAlert")
         NSAlertFirstButtonReturn = getattr(appkit, "NSAlertFirstButtonReturn")
@@ -1,7 +1,29 @@
+import logging
+import re
+from collections.abc import Iterator
+from dataclasses import dataclass
+
+import mlx.core as mx
 from mlx_lm import generate
+from mlx_lm.models.cache import can_trim_prompt_cache, make_prompt_cache
+from mlx_lm.sample_utils import make_sampler
 
 from actions import strip_action
 
+logger = logging.getLogger(__name__)
+
+_DEFAULT_SPECIAL_TOKENS = ("<|im_end|>", "<|im_start|>", "<|endoftext|>")
+
+
+def _special_tokens_pattern(tokens) -> re.Pattern:
+    # 长的在前，避免某个 token 是另一个的前缀时只删掉一半。
+    ordered = sorted({token for token in tokens if token}, key=len, reverse=True)
+    return re.compile("|".join(map(re.escape, ordered)))
+
+
+_CLEAN_RE = _special_tokens_pattern(_DEFAULT_SPECIAL_TOKENS)
+_PREFIX_RE = re.compile(r"^(?:cat[,:]|猫[,:]|干嘛猫[,:])\s*", re.IGNORECASE)
+
 
 def sanitize_role_prompt(role_prompt: str) -> str:
     if "scenarios = [" not in role_prompt:
@@ -22,6 +44,61 @@ def sanitize_role_prompt(role_prompt: str) -> str:
     return "\n".join(cleaned_lines).strip()
 
 
+_PROMPT_INTRO = "你现在要进行一次弹窗互动回应。\n"
+
+_PROMPT_RULES = (
+    "要求：\n"
+    "1) 只输出一句话，不要加角色名、不要加前缀。\n"
+    "2) 必须使用小猫视角，包含“干嘛”或“干嘛？”。\n"
+    "3) 输出不超过50字，短句口语化。\n"
+    "5) 必须回应用户输入，语气要贴合对话。\n"
+    "6) 若是连续对话，必须明确回应用户的话，最好复述用户输入中的关键词。\n"
+    "7) 不要讲道理，不要专业分析。\n\n"
+    "示例（仅作格式参考，禁止照抄）：\n"
+    "干嘛呀……本喵抱着冰红茶发呆喵~\n"
+    "干嘛叫我，我又穷又笨嘛~\n\n"
+    "请输出一句话作为弹窗内容。"
+)
+
+_TEMPLATE_PLACEHOLDER = "<<LIVE_PARTNER_PROMPT>>"
+
+# tokenizer id -> (模板前缀, 模板后缀)；模板会改写内容时记为 None，回退到完整渲染。
+_TEMPLATE_CACHE: dict[int, tuple[str, str] | None] = {}
+
+
+def _template_parts(tokenizer, content: str) -> tuple[str, str] | None:
+    key = id(tokenizer)
+    if key not in _TEMPLATE_CACHE:
+        rendered = tokenizer.apply_chat_template(
+            [{"role": "user", "content": _TEMPLATE_PLACEHOLDER}],
+            tokenize=False,
+            add_generation_prompt=True,
+        )
+        parts = rendered.split(_TEMPLATE_PLACEHOLDER)
+        cached = (parts[0], parts[1]) if len(parts) == 2 else None
+        if cached is not None:
+            expected = tokenizer.apply_chat_template(
+                [{"role": "user", "content": content}],
+                tokenize=False,
+                add_generation_prompt=True,
+            )
+            if expected != f"{cached[0]}{content}{cached[1]}":
+                cached = None
+        _TEMPLATE_CACHE[key] = cached
+    return _TEMPLATE_CACHE[key]
+
+
+def render_user_prompt(tokenizer, content: str) -> str:
+    cached = _template_parts(tokenizer, content)
+    if cached is None:
+        return tokenizer.apply_chat_template(
+            [{"role": "user", "content": content}],
+            tokenize=False,
+            add_generation_prompt=True,
+        )
+    return f"{cached[0]}{content}{cached[1]}"
+
+
 def build_chat_prompt(
     tokenizer,
     role_prompt: str,
@@ -34,33 +111,99 @@ def build_chat_prompt(
     shown_user_text = user_text.strip() or "无"
     prompt_content = (
         f"{role_prompt}\n\n"
-        "你现在要进行一次弹窗互动回应。\n"
+        f"{_PROMPT_INTRO}"
         f"对话阶段：{stage}\n"
         f"当前行为：{behavior}\n"
         f"用户输入：{shown_user_text}\n\n"
         f"最近对话（供参考，避免重复）：\n{history_text}\n\n"
         f"不要复用以下句子或近似表达：\n{avoid_text}\n\n"
-        "要求：\n"
-        "1) 只输出一句话，不要加角色名、不要加前缀。\n"
-        "2) 必须使用小猫视角，包含“干嘛”或“干嘛？”。\n"
-        "3) 输出不超过50字，短句口语化。\n"
-        "5) 必须回应用户输入，语气要贴合对话。\n"
-        "6) 若是连续对话，必须明确回应用户的话，最好复述用户输入中的关键词。\n"
-        "7) 不要讲道理，不要专业分析。\n\n"
-        "示例（仅作格式参考，禁止照抄）：\n"
-        "干嘛呀……本喵抱着冰红茶发呆喵~\n"
-        "干嘛叫我，我又穷又笨嘛~\n\n"
-        "请输出一句话作为弹窗内容。"
+        f"{_PROMPT_RULES}"
     )
-    messages = [{"role": "user", "content": prompt_content}]
-    return tokenizer.apply_chat_template(
-        messages,
-        tokenize=False,
-        add_generation_prompt=True,
+    return render_user_prompt(tokenizer, prompt_content)
+
+
+@dataclass
+class PrefixCache:
+    cache: list
+    tokens: list[int]
+
+
+def _encode(tokenizer, text: str) -> list[int]:
+    # 与 mlx_lm.generate 处理字符串提示词的方式保持一致，避免重复 BOS。
+    bos = getattr(tokenizer, "bos_token", None)
+    add_special_tokens = bos is None or not text.startswith(bos)
+    return tokenizer.encode(text, add_special_tokens=add_special_tokens)
+
+
+def draft_kwargs(draft_model, num_draft_tokens: int) -> dict:
+    if draft_model is None:
+        return {}
+    return {"draft_model": draft_model, "num_draft_tokens": num_draft_tokens}
+
+
+def make_prefix_cache(
+    model,
+    tokenizer,
+    role_prompt: str,
+    draft_model=None,
+) -> PrefixCache | None:
+    parts = _template_parts(tokenizer, role_prompt)
+    if parts is None:
+        return None
+    model_cache = make_prompt_cache(model)
+    draft_cache = make_prompt_cache(draft_model) if draft_model is not None else []
+    cache = model_cache + draft_cache
+    if not can_trim_prompt_cache(cache):
+        return None
+    tokens = _encode(tokenizer, f"{parts[0]}{role_prompt}\n\n{_PROMPT_INTRO}")
+    model(mx.array(tokens)[None], cache=model_cache)
+    if draft_model is not None:
+        draft_model(mx.array(tokens)[None], cache=draft_cache)
+    mx.eval([c.state for c in cache])
+    return PrefixCache(cache=cache, tokens=tokens)
+
+
+def _generate_with_prefix(
+    model,
+    tokenizer,
+    prompt: str,
+    max_tokens: int,
+    prefix_cache: PrefixCache | None,
+    draft_model=None,
+    num_draft_tokens: int = 4,
+    sampler=None,
+) -> str:
+    extra = draft_kwargs(draft_model, num_draft_tokens)
+    if sampler is not None:
+        extra["sampler"] = sampler
+    if prefix_cache is not None:
+        tokens = _encode(tokenizer, prompt)
+        prefix_len = len(prefix_cache.tokens)
+        if len(tokens) > prefix_len and tokens[:prefix_len] == prefix_cache.tokens:
+            try:
+                return generate(
+                    model,
+                    tokenizer,
+                    prompt=tokens[prefix_len:],
+                    max_tokens=max_tokens,
+                    verbose=False,
+                    prompt_cache=prefix_cache.cache,
+                    **extra,
+                )
+            finally:
+                for layer_cache in prefix_cache.cache:
+                    layer_cache.trim(layer_cache.offset - prefix_len)
+    return generate(
+        model,
+        tokenizer,
+        prompt=prompt,
+        max_tokens=max_tokens,
+        verbose=False,
+        **extra,
     )
 
 
-def generate_reply(
+def iter_reply_candidates(
     model,
     tokenizer,
     role_prompt: str,
@@ -70,7 +213,12 @@ def generate_reply(
     history_text: str,
     avoid_text: str,
     stage: str,
-) -> str:
+    n: int,
+    retry_temperature: float,
+    prefix_cache: PrefixCache | None = None,
+    draft_model=None,
+    num_draft_tokens: int = 4,
+) -> Iterator[str]:
     prompt = build_chat_prompt(
         tokenizer,
         role_prompt,
@@ -80,25 +228,32 @@ def generate_reply(
         avoid_text,
         stage,
     )
-    print("🧠 提示词输入:\n", prompt)
-    response = generate(
-        model,
-        tokenizer,
-        prompt=prompt,
-        max_tokens=max_tokens,
-        verbose=False,
-    )
-    return clean_reply(response)
+    logger.debug("🧠 提示词输入:\n%s", prompt)
+    retry_sampler = make_sampler(temp=retry_temperature)
+    for index in range(n):
+        response = _generate_with_prefix(
+            model,
+            tokenizer,
+            prompt,
+            max_tokens,
+            prefix_cache,
+            draft_model,
+            num_draft_tokens,
+            None if index == 0 else retry_sampler,
+        )
+        yield clean_reply(response)
+
+
+def init_clean_reply(tokenizer) -> None:
+    # 换模型后特殊 token 也会变，按当前 tokenizer 重建一次清理用的正则。
+    global _CLEAN_RE
+    tokens = getattr(tokenizer, "all_special_tokens", None) or []
+    _CLEAN_RE = _special_tokens_pattern([*_DEFAULT_SPECIAL_TOKENS, *tokens])
 
 
 def clean_reply(text: str) -> str:
-    cleaned = text.strip()
-    for token in ("<|im_end|>", "<|im_start|>", "<|endoftext|>"):
-        cleaned = cleaned.replace(token, "")
-    for prefix in ("cat,", "cat:", "猫,", "猫:", "干嘛猫:", "干嘛猫,"):
-        if cleaned.lower().startswith(prefix):
-            cleaned = cleaned[len(prefix):].strip()
-            break
+    cleaned = _CLEAN_RE.sub("", text.strip())
+    cleaned = _PREFIX_RE.sub("", cleaned, count=1)
     cleaned = cleaned.replace("`(", "(").replace(")`", ")")
     cleaned = strip_action(cleaned).strip(" \n\r\t\"'")
     if "干嘛" not in cleaned: